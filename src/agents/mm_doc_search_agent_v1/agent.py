@@ -1,12 +1,18 @@
 import os
-import re
+import asyncio
 
+from google import genai
 from google.cloud import aiplatform
 from google.adk.agents.callback_context import CallbackContext
+from google.adk.models.llm_request import LlmRequest
 from google.adk.models.llm_response import LlmResponse
-from google.adk.agents import Agent, SequentialAgent
+from google.adk.agents import Agent
 from google.adk.tools import VertexAiSearchTool
 
+from .citation_formatting_agent import CitationFormattingAgent
+from .semantic_cache import SemanticCache
+from .uri_masking import mask_grounding_chunk_uris, replace_masked_uris
+
 os.environ["GOOGLE_GENAI_USE_VERTEXAI"] = "true"
 
 PROJECT_ID = ""
@@ -26,6 +32,106 @@ vertex_ai_search = VertexAiSearchTool(
     data_store_id=DATA_STORE_ID
 )
 
+# Semantic cache for search agent responses
+# Paraphrased questions reuse the grounded response (and its grounding chunks) of a
+# previous similar question instead of issuing another model + search call.
+# Only the first turn of a session is cached, since later turns depend on conversation history.
+SEMANTIC_CACHE_ENABLED = os.environ.get("MM_DOC_SEARCH_SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_PATH = os.environ.get("MM_DOC_SEARCH_SEMANTIC_CACHE_PATH", ".cache/mm_doc_search_semantic_cache.jsonl")
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("MM_DOC_SEARCH_SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_TTL_SECONDS = int(os.environ.get("MM_DOC_SEARCH_SEMANTIC_CACHE_TTL_SECONDS", "86400"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("MM_DOC_SEARCH_SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+EMBEDDING_MODEL = "text-embedding-005"
+
+# Session state keys (temp: prefix is not persisted) holding the query of a cache miss
+# and its embedding, so the embedding is reused when the response is stored
+SEMANTIC_CACHE_QUERY_STATE_KEY = "temp:semantic_cache_query"
+SEMANTIC_CACHE_VECTOR_STATE_KEY = "temp:semantic_cache_vector"
+
+semantic_cache = None
+if SEMANTIC_CACHE_ENABLED:
+    embedding_client = genai.Client(vertexai=True, project=PROJECT_ID, location=LOCATION)
+
+    def embed_query(text):
+        response = embedding_client.models.embed_content(model=EMBEDDING_MODEL, contents=text)
+        return response.embeddings[0].values
+
+    semantic_cache = SemanticCache(
+        embed_query,
+        path=SEMANTIC_CACHE_PATH,
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS,
+        max_entries=SEMANTIC_CACHE_MAX_ENTRIES
+    )
+
+def get_first_turn_user_query(llm_request: LlmRequest):
+    """Returns the user query if the request holds only the first user turn of a session, else None."""
+    # Follow-ups ("tell me more") only make sense with their history, so they are never cached
+    if not llm_request.contents or len(llm_request.contents) != 1:
+        return None
+    user_content = llm_request.contents[0]
+    if user_content.role != "user" or not user_content.parts:
+        return None
+    texts = [part.text for part in user_content.parts if part.text]
+    # Function responses etc. are not user questions
+    if len(texts) != len(user_content.parts):
+        return None
+    return " ".join(texts)
+
+async def lookup_doc_search_response_in_semantic_cache(
+    callback_context: CallbackContext, llm_request: LlmRequest
+):
+    """Callback returning a cached grounded response for semantically similar questions."""
+    if not semantic_cache:
+        return None
+
+    query = get_first_turn_user_query(llm_request)
+    if not query:
+        return None
+
+    try:
+        cached, vector = await asyncio.to_thread(semantic_cache.lookup, query)
+    except Exception as e:
+        print(f"[Semantic Cache] Lookup failed: {e}")
+        return None
+
+    if cached is None:
+        callback_context.state[SEMANTIC_CACHE_QUERY_STATE_KEY] = query
+        callback_context.state[SEMANTIC_CACHE_VECTOR_STATE_KEY] = vector
+        return None
+
+    print("[Semantic Cache] Hit, reusing cached search response.")
+    llm_response = LlmResponse.model_validate(cached)
+    # after_model_callback is skipped for responses returned here, so mask URIs now
+    process_doc_search_agent_response_for_grounding_metadata(callback_context, llm_response)
+    return llm_response
+
+async def store_doc_search_response_in_semantic_cache(
+    callback_context: CallbackContext, llm_response: LlmResponse
+):
+    """Callback caching final grounded responses (before URI masking) for the missed query."""
+    if not semantic_cache or llm_response.partial or llm_response.error_code:
+        return None
+    if not llm_response.content or not llm_response.grounding_metadata:
+        return None
+    if not llm_response.grounding_metadata.grounding_chunks:
+        return None
+
+    query = callback_context.state.get(SEMANTIC_CACHE_QUERY_STATE_KEY)
+    if not query:
+        return None
+    vector = callback_context.state.get(SEMANTIC_CACHE_VECTOR_STATE_KEY)
+    callback_context.state[SEMANTIC_CACHE_QUERY_STATE_KEY] = None
+    callback_context.state[SEMANTIC_CACHE_VECTOR_STATE_KEY] = None
+
+    try:
+        await asyncio.to_thread(
+            semantic_cache.store, query, llm_response.model_dump(mode="json", exclude_none=True), vector
+        )
+    except Exception as e:
+        print(f"[Semantic Cache] Store failed: {e}")
+    return None
+
 def process_doc_search_agent_response_for_grounding_metadata(
     callback_context: CallbackContext, llm_response: LlmResponse
 ):
@@ -40,32 +146,19 @@ def process_doc_search_agent_response_for_grounding_metadata(
         # Retrieve or initialize the URI map from session state
         # state is accessed via callback_context.state, which behaves like a dict
         uri_map = callback_context.state.get("grounding_metadata_uri_map", {})
+        # Reverse map (original URI -> key) for O(1) lookups of already-masked URIs
+        uri_to_key = callback_context.state.get("grounding_metadata_uri_rev")
+        if uri_to_key is None or len(uri_to_key) != len(uri_map):
+            uri_to_key = {value: key for key, value in uri_map.items()}
         
         # We need to know the next index for new URIs
         # We can't just use len(uri_map) if we might have gaps or want strict ordering, 
         # but for this simple masking, len+1 is fine as we append.
-        
-        for chunk in llm_response.grounding_metadata.grounding_chunks:
-            if chunk.retrieved_context and chunk.retrieved_context.uri:
-                original_uri = chunk.retrieved_context.uri
-                
-                # Check if this URI is already mapped
-                found_key = None
-                for key, value in uri_map.items():
-                    if value == original_uri:
-                        found_key = key
-                        break
-                
-                if not found_key:
-                    next_id = len(uri_map) + 1
-                    found_key = f"uri_{next_id}"
-                    uri_map[found_key] = original_uri
-                
-                # Mask the URI in the response object
-                chunk.retrieved_context.uri = found_key
-
-        # Save the updated map back to session state
+        mask_grounding_chunk_uris(llm_response.grounding_metadata.grounding_chunks, uri_map, uri_to_key)
+
+        # Save the updated maps back to session state
         callback_context.state["grounding_metadata_uri_map"] = uri_map
+        callback_context.state["grounding_metadata_uri_rev"] = uri_to_key
 
         print(llm_response.grounding_metadata.grounding_chunks)
 
@@ -81,20 +174,16 @@ def process_doc_search_output_formatting_response_to_replace_uri(
     if not llm_response.content or not llm_response.content.parts:
         return
 
-    # Replace [[uri_X]] with [actual_uri]
-    def replace_uri(match):
-        uri_key = match.group(1)
-        actual_uri = uri_map.get(uri_key, uri_key)
-        return f"[{actual_uri}]"
-
-    # Iterate over parts and replace text in text parts
+    # Iterate over parts and replace [[uri_X]] with [actual_uri] in text parts
     for part in llm_response.content.parts:
         if part.text:
-            new_text = re.sub(r"\[\[(uri_\d+)\]\]", replace_uri, part.text)
-            part.text = new_text
+            part.text = replace_masked_uris(part.text, uri_map)
 
 
 # Define the Agent System Instruction
+# Instructions are passed as `static_instruction` so ADK sends them verbatim (no state
+# templating) ahead of all per-turn content. Keep them free of timestamps, IDs or other
+# dynamic values so the prompt prefix stays byte-identical and eligible for prompt caching.
 INSTRUCTION = """
   
   **Role:**
@@ -142,25 +231,33 @@ mm_doc_search_agent = Agent(
     name="mm_doc_search_agent",
     model="gemini-2.5-flash",
     description="This agent searches MM documents data store to answer user queries using Vertex AI Search.",
-    instruction=INSTRUCTION,
+    static_instruction=INSTRUCTION,
+    # VertexAiSearchTool is a built-in tool: retrieval runs inside the Gemini request, not as a
+    # client-side function call, so there are no local tool calls for ADK to run in parallel.
+    # If function tools are added here, ADK already executes a turn's function calls concurrently.
     tools=[vertex_ai_search],
-    after_model_callback=process_doc_search_agent_response_for_grounding_metadata
+    before_model_callback=lookup_doc_search_response_in_semantic_cache,
+    # Cache the response before its grounding URIs are masked (masks are per session)
+    after_model_callback=[
+        store_doc_search_response_in_semantic_cache,
+        process_doc_search_agent_response_for_grounding_metadata
+    ]
 )
 
 mm_doc_search_agent_output_formatting_agent = Agent(
     name="mm_doc_search_agent_output_formatting_agent",
     model="gemini-2.5-flash",
     description="This agent formats the output of a search agent.",
-    instruction=MM_DOC_SEARCH_AGENT_OUTPUT_FORMATTING_INSTRUCTION,
+    static_instruction=MM_DOC_SEARCH_AGENT_OUTPUT_FORMATTING_INSTRUCTION,
     after_model_callback=process_doc_search_output_formatting_response_to_replace_uri
 )
 
-root_agent = SequentialAgent(
+# Citations are inserted from the search response's grounding supports as soon as it
+# completes; the formatting agent only runs when those are missing.
+root_agent = CitationFormattingAgent(
     name="mm_doc_search_agent_with_output_formatting",
     description="This agent searches MM documents data store to answer user queries using Vertex AI Search.",
-    sub_agents=[
-        mm_doc_search_agent, 
-        mm_doc_search_agent_output_formatting_agent
-    ]
+    search_agent=mm_doc_search_agent,
+    formatting_agent=mm_doc_search_agent_output_formatting_agent
 )
 
@@ -0,0 +1,90 @@
+from typing import AsyncGenerator
+
+from google.genai import types
+from google.adk.agents import BaseAgent
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.events import Event
+
+from .uri_masking import insert_citations
+
+
+class CitationFormattingAgent(BaseAgent):
+    """
+    Runs the search agent, then cites its answer without waiting on a second model call.
+
+    The search agent's final response carries grounding supports (text segment -> chunk
+    indices), so citations can be inserted directly as soon as it finishes. The formatting
+    agent only runs as a fallback when the response has no usable grounding supports.
+    """
+
+    search_agent: BaseAgent
+    formatting_agent: BaseAgent
+
+    def __init__(self, name: str, description: str, search_agent: BaseAgent, formatting_agent: BaseAgent):
+        super().__init__(
+            name=name,
+            description=description,
+            search_agent=search_agent,
+            formatting_agent=formatting_agent,
+            sub_agents=[search_agent, formatting_agent]
+        )
+
+    def _cite_final_response(self, ctx: InvocationContext, event: Event):
+        """Returns the answer text with inline citations, or None if it cannot be derived."""
+        grounding_metadata = event.grounding_metadata
+        if not grounding_metadata or not grounding_metadata.grounding_supports:
+            return None
+        if not grounding_metadata.grounding_chunks:
+            return None
+        if not event.content or not event.content.parts:
+            return None
+
+        parts = event.content.parts
+        # Segment offsets are byte offsets within the part named by segment.part_index
+        supports_by_part = {}
+        for support in grounding_metadata.grounding_supports:
+            if not support.segment:
+                continue
+            part_index = support.segment.part_index or 0
+            supports_by_part.setdefault(part_index, []).append(support)
+        if not supports_by_part:
+            return None
+
+        uri_map = ctx.session.state.get("grounding_metadata_uri_map", {})
+        texts = {i: part.text for i, part in enumerate(parts) if part.text and not part.thought}
+        for part_index, supports in supports_by_part.items():
+            if part_index not in texts:
+                return None
+            cited = insert_citations(
+                texts[part_index],
+                supports,
+                grounding_metadata.grounding_chunks,
+                uri_map
+            )
+            if cited is None:
+                return None
+            texts[part_index] = cited
+
+        if not texts:
+            return None
+        return "".join(texts[i] for i in sorted(texts))
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        final_event = None
+        async for event in self.search_agent.run_async(ctx):
+            if not event.partial and event.content:
+                final_event = event
+            yield event
+
+        cited_text = self._cite_final_response(ctx, final_event) if final_event else None
+        if cited_text is None:
+            async for event in self.formatting_agent.run_async(ctx):
+                yield event
+            return
+
+        yield Event(
+            invocation_id=ctx.invocation_id,
+            author=self.formatting_agent.name,
+            branch=ctx.branch,
+            content=types.Content(role="model", parts=[types.Part(text=cited_text)])
+        )
@@ -0,0 +1,133 @@
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+
+
+def normalize_query(query):
+    """Lowercases and collapses whitespace so trivially different queries share a key."""
+    return " ".join(query.lower().split())
+
+
+def _unit_vector(values):
+    norm = math.sqrt(sum(v * v for v in values))
+    if not norm:
+        return list(values)
+    return [v / norm for v in values]
+
+
+class SemanticCache:
+    """
+    Embedding based response cache.
+
+    Entries are (normalized query, unit embedding, response) triples. A lookup returns the
+    stored response of the most similar entry when its cosine similarity exceeds `threshold`.
+    Entries are persisted as JSONL at `path` so the cache survives restarts.
+    """
+
+    def __init__(self, embed_fn, path=None, threshold=0.9, ttl_seconds=86400, max_entries=1000):
+        self.embed_fn = embed_fn
+        self.path = path
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = []
+        # Lines in the JSONL file, which can exceed the live entries once some expire
+        self._file_lines = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _is_expired(self, entry, now):
+        return bool(self.ttl_seconds) and now - entry["created_at"] > self.ttl_seconds
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        now = time.time()
+        with open(self.path, "r") as f:
+            for line in f:
+                self._file_lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if not self._is_expired(entry, now):
+                    self._entries.append(entry)
+        self._entries = self._entries[-self.max_entries:]
+
+    def _rewrite(self):
+        if not self.path:
+            return
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                for entry in self._entries:
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(tmp_path, self.path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._file_lines = len(self._entries)
+
+    def _append(self, entry):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+        self._file_lines += 1
+
+    def lookup(self, query):
+        """
+        Returns (response, vector) for the query. `response` is the cached response of a
+        similar query, or None on a miss. `vector` is the query embedding computed for the
+        lookup (None if none was needed), which callers can pass on to `store`.
+        """
+        key = normalize_query(query)
+        if not key:
+            return None, None
+        now = time.time()
+
+        with self._lock:
+            self._entries = [e for e in self._entries if not self._is_expired(e, now)]
+            # Exact matches need no embedding call
+            for entry in reversed(self._entries):
+                if entry["query"] == key:
+                    return entry["response"], None
+
+        vector = _unit_vector(self.embed_fn(key))
+
+        with self._lock:
+            best_entry, best_score = None, -1.0
+            for entry in self._entries:
+                score = sum(a * b for a, b in zip(vector, entry["vector"]))
+                if score > best_score:
+                    best_entry, best_score = entry, score
+            if best_entry is not None and best_score >= self.threshold:
+                return best_entry["response"], vector
+        return None, vector
+
+    def store(self, query, response, vector=None):
+        """Caches `response` for `query`, reusing the embedding returned by `lookup` if given."""
+        key = normalize_query(query)
+        if not key:
+            return
+        if vector is None:
+            vector = _unit_vector(self.embed_fn(key))
+
+        now = time.time()
+        entry = {"query": key, "vector": vector, "response": response, "created_at": now}
+        with self._lock:
+            self._entries = [e for e in self._entries if not self._is_expired(e, now)]
+            self._entries.append(entry)
+            self._entries = self._entries[-self.max_entries:]
+            # Compact once the file holds more lines (expired or evicted) than the cap allows
+            if self._file_lines + 1 > self.max_entries:
+                self._rewrite()
+            else:
+                self._append(entry)
@@ -0,0 +1,90 @@
+"""
+Hot-path helpers for masking grounding URIs and restoring them in formatted output.
+
+This module is plain Python with no ADK imports so it can optionally be compiled with
+Cython for high-QPS deployments (`cythonize -i uri_masking.py`). When a compiled
+extension is present next to this file, Python imports it in preference to the source.
+"""
+import re
+
+# Matches masked citations like [[uri_1]] in the formatting agent output
+URI_RE = re.compile(r"\[\[(uri_\d+)\]\]")
+
+
+def mask_grounding_chunk_uris(grounding_chunks, uri_map, uri_to_key):
+    """Replaces chunk URIs with stable uri_N keys, updating both maps in place."""
+    for chunk in grounding_chunks:
+        retrieved_context = chunk.retrieved_context
+        if not retrieved_context:
+            continue
+        original_uri = retrieved_context.uri
+        if not original_uri:
+            continue
+
+        # Check if this URI is already mapped
+        found_key = uri_to_key.get(original_uri)
+        if not found_key:
+            found_key = "uri_" + str(len(uri_map) + 1)
+            uri_map[found_key] = original_uri
+            uri_to_key[original_uri] = found_key
+
+        # Mask the URI in the response object
+        retrieved_context.uri = found_key
+
+
+def replace_masked_uris(text, uri_map):
+    """Replaces [[uri_X]] markers in `text` with [actual_uri]."""
+    # Skip the regex engine entirely when there is no citation marker
+    if "[[" not in text:
+        return text
+
+    def replace_uri(match):
+        uri_key = match.group(1)
+        return "[" + uri_map.get(uri_key, uri_key) + "]"
+
+    return URI_RE.sub(replace_uri, text)
+
+
+def insert_citations(text, grounding_supports, grounding_chunks, uri_map):
+    """
+    Inserts [actual_uri] citations after each grounded segment of `text`.
+
+    `text` is a single response part and `grounding_supports` must be the supports whose
+    segment.part_index refers to that part, as offsets are UTF-8 byte offsets within it.
+    Chunk URIs are expected to be masked (uri_N), and are resolved through `uri_map`.
+    Returns None when the supports cannot be applied to `text`.
+    """
+    data = text.encode("utf-8")
+    insertions = {}
+    for support in grounding_supports:
+        segment = support.segment
+        if not segment or segment.end_index is None or not support.grounding_chunk_indices:
+            continue
+        if segment.end_index > len(data):
+            return None
+        keys = insertions.setdefault(segment.end_index, [])
+        for chunk_index in support.grounding_chunk_indices:
+            if chunk_index >= len(grounding_chunks):
+                continue
+            retrieved_context = grounding_chunks[chunk_index].retrieved_context
+            if retrieved_context and retrieved_context.uri and retrieved_context.uri not in keys:
+                keys.append(retrieved_context.uri)
+
+    pieces = []
+    last_index = 0
+    for end_index in sorted(insertions):
+        keys = insertions[end_index]
+        if not keys:
+            continue
+        citations = " ".join("[" + uri_map.get(key, key) + "]" for key in keys)
+        pieces.append(data[last_index:end_index])
+        pieces.append((" " + citations).encode("utf-8"))
+        last_index = end_index
+    if not pieces:
+        return None
+    pieces.append(data[last_index:])
+
+    try:
+        return b"".join(pieces).decode("utf-8")
+    except UnicodeDecodeError:
+        return None
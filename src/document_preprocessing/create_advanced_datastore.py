@@ -1,11 +1,26 @@
 import json
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import google.auth
 from google.auth.transport.requests import Request
 
 import argparse
 
+class NonIdempotentSafeRetry(Retry):
+    """
+    Retry that only resends requests outside `allowed_methods` (e.g. POST) on 429.
+    A create/import POST answered with 5xx may still have been applied server side,
+    so resending it could hit a 409 or start a duplicate operation. Connection errors
+    are retried for every method, as the request never reached the server.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() not in self.allowed_methods:
+            return status_code == 429 and bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
 def get_authenticated_session(project_id):
     credentials, _ = google.auth.default()
     credentials.refresh(Request())
@@ -15,8 +30,32 @@ def get_authenticated_session(project_id):
         "Content-Type": "application/json",
         "X-Goog-User-Project": project_id
     })
+    # Keep credentials around so an expired token can be refreshed mid-run
+    session.credentials = credentials
+
+    # Reuse pooled connections and retry transient failures with backoff
+    # GET retries on 429/5xx and read errors; POST only on 429 and connection errors
+    retry = NonIdempotentSafeRetry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retry)
+    session.mount("https://", adapter)
     return session
 
+def request_with_reauth(session, method, url, **kwargs):
+    """Sends a request, refreshing the access token and retrying once on 401."""
+    response = session.request(method, url, **kwargs)
+    if response.status_code == 401 and getattr(session, "credentials", None):
+        print("Access token rejected, refreshing credentials and retrying...")
+        session.credentials.refresh(Request())
+        session.headers["Authorization"] = f"Bearer {session.credentials.token}"
+        response = session.request(method, url, **kwargs)
+    return response
+
 def create_data_store(session, project_id, location, collection, data_store_id, display_name):
     parent = f"projects/{project_id}/locations/{location}/collections/{collection}"
     url = f"https://discoveryengine.googleapis.com/v1beta/{parent}/dataStores?dataStoreId={data_store_id}"
@@ -42,7 +81,7 @@ def create_data_store(session, project_id, location, collection, data_store_id,
     }
     
     print(f"Creating Data Store via REST API: {data_store_id}...")
-    response = session.post(url, json=payload)
+    response = request_with_reauth(session, "POST", url, json=payload)
     
     if response.status_code == 200:
         print("Operation started successfully.")
@@ -55,6 +94,36 @@ def create_data_store(session, project_id, location, collection, data_store_id,
         print(response.text)
         return None
 
+def wait_for_operation(session, operation_name, timeout=300, initial_delay=0.5, max_delay=4.0):
+    """Polls a long-running operation with exponential backoff until it is done or times out."""
+    url = f"https://discoveryengine.googleapis.com/v1beta/{operation_name}"
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    
+    print(f"Waiting for operation {operation_name}...")
+    while True:
+        response = request_with_reauth(session, "GET", url)
+        if response.status_code != 200:
+            print(f"Error polling operation: {response.status_code}")
+            print(response.text)
+            return None
+        
+        operation = response.json()
+        if operation.get("done"):
+            if "error" in operation:
+                print("Operation failed:")
+                print(json.dumps(operation["error"], indent=2))
+                return None
+            print("Operation completed.")
+            return operation
+        
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            print(f"Timed out after {timeout} seconds waiting for operation {operation_name}.")
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
 def import_documents(session, project_id, location, collection, data_store_id, gcs_uri):
     parent = f"projects/{project_id}/locations/{location}/collections/{collection}/dataStores/{data_store_id}/branches/default_branch"
     url = f"https://discoveryengine.googleapis.com/v1beta/{parent}/documents:import"
@@ -68,7 +137,7 @@ def import_documents(session, project_id, location, collection, data_store_id, g
     }
     
     print(f"Importing documents from {gcs_uri}...")
-    response = session.post(url, json=payload)
+    response = request_with_reauth(session, "POST", url, json=payload)
     
     if response.status_code == 200:
         print("Import Operation started.")
@@ -88,6 +157,7 @@ def main():
     parser.add_argument("--display-name", required=True, help="Data Store Display Name")
     parser.add_argument("--gcs-uri", required=True, help="GCS URI for metadata.jsonl")
     parser.add_argument("--skip-create", action="store_true", help="Skip data store creation, only import")
+    parser.add_argument("--operation-timeout", type=float, default=300, help="Seconds to wait for Data Store creation to complete")
     
     args = parser.parse_args()
     
@@ -95,9 +165,17 @@ def main():
     
     if not args.skip_create:
         create_res = create_data_store(session, args.project_id, args.location, args.collection, args.data_store_id, args.display_name)
+        if isinstance(create_res, dict) and create_res.get("name"):
+            # Creation returns a long-running operation, wait until the Data Store is ready
+            if not create_res.get("done"):
+                create_res = wait_for_operation(session, create_res["name"], timeout=args.operation_timeout)
+            elif "error" in create_res:
+                print(json.dumps(create_res["error"], indent=2))
+                create_res = None
+            if not create_res:
+                print("Data Store is not ready. Re-run with --skip-create once it is available.")
+                return
         if create_res:
-            print("Waiting 10 seconds for Data Store creation to propagate...")
-            time.sleep(10)
             import_documents(session, args.project_id, args.location, args.collection, args.data_store_id, args.gcs_uri)
     else:
         import_documents(session, args.project_id, args.location, args.collection, args.data_store_id, args.gcs_uri)
@@ -1,8 +1,13 @@
 import os
 import json
+import tempfile
 import hashlib
 import time
+import asyncio
 import argparse
+import itertools
+import functools
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import logging
 
@@ -14,17 +19,46 @@ logger = logging.getLogger(__name__)
 try:
     from google import genai
     from google.genai import types
+    import httpx
     HAS_GENAI = True
 except ImportError:
     HAS_GENAI = False
 
-def generate_doc_id(filename):
-    """Generates a safe document ID from the filename."""
-    return hashlib.md5(filename.encode()).hexdigest()
+# HTTP/2 support in httpx needs the optional h2 package
+try:
+    import h2  # noqa: F401
+    HAS_HTTP2 = True
+except ImportError:
+    HAS_HTTP2 = False
+
+# Try importing orjson for faster serialization
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
 
-def get_file_metadata(filepath):
-    """Extracts basic file metadata using OS stats."""
-    stat = os.stat(filepath)
+# Every upper/lower case spelling of ".pdf", so str.endswith can match without lowercasing
+_PDF_SUFFIXES = tuple("." + "".join(chars) for chars in itertools.product("pP", "dD", "fF"))
+
+def is_pdf_filename(name):
+    """Case-insensitive check for a .pdf extension without allocating a lowercased copy."""
+    return name.endswith(_PDF_SUFFIXES)
+
+def generate_doc_id(filename, hash_algo="blake2b"):
+    """Generates a safe 128-bit hex document ID from the filename."""
+    if hash_algo == "md5":
+        return hashlib.md5(filename.encode("utf-8")).hexdigest()
+    return hashlib.blake2b(filename.encode("utf-8"), digest_size=16).hexdigest()
+
+def generate_doc_ids(filenames, hash_algo="blake2b"):
+    """Generates document IDs for a batch of filenames in one pass."""
+    return [generate_doc_id(f, hash_algo) for f in filenames]
+
+def get_file_metadata(filepath, stat=None):
+    """Extracts basic file metadata using OS stats (reuses `stat` when already available)."""
+    if stat is None:
+        stat = os.stat(filepath)
     return {
         "size_bytes": stat.st_size,
         "created_timestamp": int(stat.st_ctime),
@@ -33,38 +67,202 @@ def get_file_metadata(filepath):
         "modified_iso": datetime.fromtimestamp(stat.st_mtime).isoformat()
     }
 
+def serialize_records(records):
+    """Serializes records to a single NDJSON byte buffer."""
+    if not records:
+        return b""
+    if HAS_ORJSON:
+        dumps = orjson.dumps
+        return b"\n".join([dumps(r) for r in records]) + b"\n"
+    return "".join([json.dumps(r) + "\n" for r in records]).encode("utf-8")
+
+# Maps '-' and '_' to spaces in a single str.translate pass
+_TITLE_SEPARATORS = str.maketrans('-_', '  ')
+
+def load_previous_records(output_file):
+    """Loads records from a previous run's NDJSON output, indexed by filename."""
+    previous = {}
+    if not os.path.exists(output_file):
+        return previous
+    loads = orjson.loads if HAS_ORJSON else json.loads
+    with open(output_file, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = loads(line)
+                previous[record["structData"]["filename"]] = record
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Skipping unreadable record in {output_file}: {e}")
+    return previous
+
+def digest_prompt(prompt_text):
+    """Short BLAKE2b digest identifying the extraction prompt."""
+    return hashlib.blake2b(prompt_text.encode("utf-8"), digest_size=16).hexdigest()
+
+def reuse_unchanged_record(record, previous_record, model_id, prompt_digest):
+    """
+    Carries over upload date and AI attributes when the file is unchanged since the previous run
+    and its attributes were produced by the same model and prompt.
+    """
+    struct_data = record["structData"]
+    previous_struct_data = previous_record.get("structData", {})
+    if previous_struct_data.get("ai_model_id") != model_id:
+        return False
+    if previous_struct_data.get("ai_prompt_digest") != prompt_digest:
+        return False
+    if previous_struct_data.get("modified_timestamp") != struct_data["modified_timestamp"]:
+        return False
+    if previous_struct_data.get("file_size") != struct_data["file_size"]:
+        return False
+    if "ai_inferred_attributes" not in previous_struct_data:
+        return False
+    struct_data["upload_date"] = previous_struct_data.get("upload_date", struct_data["upload_date"])
+    struct_data["ai_inferred_attributes"] = previous_struct_data["ai_inferred_attributes"]
+    struct_data["ai_model_id"] = model_id
+    struct_data["ai_prompt_digest"] = prompt_digest
+    return True
+
 def clean_filename_to_title(filename):
     """Converts a filename like 'some-report-v.2.0.pdf' to 'Some Report V.2.0'"""
-    name = os.path.splitext(filename)[0]
-    name = name.replace('-', ' ').replace('_', ' ')
-    name = ' '.join(name.split())
-    return name.title()
+    name = os.path.splitext(filename)[0].translate(_TITLE_SEPARATORS)
+    return ' '.join(name.split()).title()
+
+def build_async_http_client(concurrency):
+    """
+    Builds the httpx client shared by all async GenAI calls, with a pool sized for the workers.
+    It is passed to GenAI explicitly because `async_client_args` pool settings are silently
+    dropped when google-genai picks its aiohttp transport (the `aiohttp` extra).
+    """
+    pool_size = max(32, concurrency)
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=pool_size, max_connections=pool_size * 2),
+        http2=HAS_HTTP2,
+        # GenAI passes per-request timeouts; PDF extraction calls can take minutes
+        timeout=None
+    )
+
+class RateLimiter:
+    """Spaces out request starts so at most `rate` calls begin per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        if not self.interval:
+            return self
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
 
-def infer_attributes(filepath, client, model_id, prompt_text):
-    """Uses Gemini to extract attributes from the PDF."""
+def read_file_bytes(filepath):
+    with open(filepath, "rb") as f:
+        return f.read()
+
+def hash_file_content(filepath, chunk_size=1024 * 1024):
+    """Computes a BLAKE2b digest of the file contents without loading it fully into memory."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def prepare_pdf_input(filepath, gcs_uri, pdf_source, compute_digest=True):
+    """
+    Builds the PDF input part and returns it with the digest of the PDF contents.
+    The digest is only needed for caching; with `compute_digest=False` it is None.
+    """
+    if pdf_source == "gcs":
+        # Gemini reads the PDF from GCS directly, no local read or upload needed
+        pdf_part = types.Part.from_uri(file_uri=gcs_uri, mime_type="application/pdf")
+        return pdf_part, hash_file_content(filepath) if compute_digest else None
+    pdf_bytes = read_file_bytes(filepath)
+    pdf_part = types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")
+    if not compute_digest:
+        return pdf_part, None
+    return pdf_part, hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+
+class MetadataCache:
+    """On-disk cache of AI inferred attributes keyed by PDF content, model and prompt."""
+
+    def __init__(self, cache_dir, model_id, prompt_text):
+        self.cache_dir = cache_dir
+        self.model_id = model_id
+        self.prompt_digest = digest_prompt(prompt_text)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, content_digest):
+        # Model or prompt changes produce new keys, invalidating old entries
+        h = hashlib.blake2b(digest_size=16)
+        for part in (content_digest, self.model_id, self.prompt_digest):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.cache_dir, key + ".json")
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable cache entry {path}: {e}")
+            return None
+
+    def put(self, key, data):
+        path = os.path.join(self.cache_dir, key + ".json")
+        # Write to a temp file and rename so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write cache entry {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+# Appended to the system prompt when several PDFs are sent in one request
+BATCH_PROMPT_SUFFIX = """
+
+You will receive {count} documents in this request. Each document is preceded by a line of the form "Document filename: <filename>".
+Analyze each document independently and return a VALID JSON array with exactly one object per document, in the same order.
+Each object must follow the structure above and additionally include a "filename" field containing the exact filename given for that document.
+"""
+
+async def agenerate_json(parts, client, model_id, system_instruction, description):
+    """
+    Sends `parts` to Gemini (async client) and returns the parsed JSON response.
+    Returns None when the library is missing, the response is empty or the call fails.
+    """
     if not HAS_GENAI:
         logger.error("google-genai library not installed. Skipping AI inference.")
         return None
 
     try:
-        logger.info(f"AI Processing: {os.path.basename(filepath)}...")
-        
-        with open(filepath, "rb") as f:
-            pdf_bytes = f.read()
+        logger.info(f"AI Processing: {description}...")
 
-        response = client.models.generate_content(
+        response = await client.aio.models.generate_content(
             model=model_id,
             contents=[
                 types.Content(
                     role="user",
-                    parts=[
-                        types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")
-                    ]
+                    parts=parts
                 )
             ],
             config=types.GenerateContentConfig(
                 response_mime_type="application/json",
-                system_instruction=prompt_text
+                system_instruction=system_instruction
             )
         )
         
@@ -73,14 +271,176 @@ def infer_attributes(filepath, client, model_id, prompt_text):
         return None
 
     except Exception as e:
-        logger.error(f"Error during AI inference for {filepath}: {e}")
+        logger.error(f"Error during AI inference for {description}: {e}")
         return None
 
+async def ainfer_attributes_batch(items, client, model_id, prompt_text):
+    """
+    Uses Gemini (async client) to extract attributes for several PDFs in a single request.
+    `items` is a list of (filename, pdf_part). Returns a dict of filename -> attributes,
+    omitting documents the model did not return.
+    """
+    filenames = [filename for filename, _ in items]
+    parts = []
+    for filename, pdf_part in items:
+        parts.append(types.Part.from_text(text=f"Document filename: {filename}"))
+        parts.append(pdf_part)
+
+    data = await agenerate_json(
+        parts, client, model_id,
+        prompt_text + BATCH_PROMPT_SUFFIX.format(count=len(items)),
+        f"batch of {len(items)} ({', '.join(filenames)})"
+    )
+
+    results = {}
+    if data is None:
+        return results
+    if not isinstance(data, list):
+        logger.warning(f"Batch response was not a JSON array for {', '.join(filenames)}")
+        return results
+    for entry in data:
+        if isinstance(entry, dict) and entry.get("filename") in filenames:
+            results[entry.pop("filename")] = entry
+    return results
+
+async def ainfer_attributes(filename, pdf_part, client, model_id, prompt_text):
+    """Uses Gemini (async client) to extract attributes from the PDF part."""
+    return await agenerate_json([pdf_part], client, model_id, prompt_text, filename)
+
+async def produce_pdf_parts(records, target_dir, queue, num_consumers, pdf_source, cache, batch_size, batch_max_bytes):
+    """
+    Prepares PDF parts ahead of the consumers so disk I/O overlaps in-flight requests.
+    Parts are queued in batches of up to `batch_size` PDFs and `batch_max_bytes` total size.
+    """
+    batch = []
+    batch_bytes = 0
+    for record in records:
+        struct_data = record["structData"]
+        filepath = os.path.join(target_dir, struct_data["filename"])
+        try:
+            pdf_part, content_digest = await asyncio.to_thread(prepare_pdf_input, filepath, struct_data["gcs_uri"], pdf_source, cache is not None)
+        except OSError as e:
+            logger.error(f"Error reading {filepath}: {e}")
+            continue
+
+        cache_key = None
+        if cache:
+            cache_key = cache.key(content_digest)
+            ai_data = await asyncio.to_thread(cache.get, cache_key)
+            if ai_data:
+                logger.info(f"Cache hit: {struct_data['filename']}")
+                struct_data["ai_inferred_attributes"] = ai_data
+                continue
+
+        file_size = struct_data["file_size"]
+        if batch and (len(batch) >= batch_size or batch_bytes + file_size > batch_max_bytes):
+            await queue.put(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append((record, pdf_part, cache_key))
+        batch_bytes += file_size
+
+    if batch:
+        await queue.put(batch)
+
+    # One sentinel per consumer signals the end of the stream
+    for _ in range(num_consumers):
+        await queue.put(None)
+
+async def consume_pdf_parts(queue, client, model_id, prompt_text, limiter, cache):
+    """Sends queued PDF batches to Gemini and attaches the inferred attributes to their records."""
+
+    async def attach(record, cache_key, ai_data):
+        record["structData"]["ai_inferred_attributes"] = ai_data
+        if cache:
+            await asyncio.to_thread(cache.put, cache_key, ai_data)
+
+    while True:
+        batch = await queue.get()
+        if batch is None:
+            break
+
+        remaining = batch
+        if len(batch) > 1:
+            async with limiter:
+                results = await ainfer_attributes_batch(
+                    [(record["structData"]["filename"], pdf_part) for record, pdf_part, _ in batch],
+                    client, model_id, prompt_text
+                )
+            remaining = []
+            for record, pdf_part, cache_key in batch:
+                ai_data = results.get(record["structData"]["filename"])
+                if ai_data:
+                    await attach(record, cache_key, ai_data)
+                else:
+                    remaining.append((record, pdf_part, cache_key))
+            if remaining:
+                logger.warning(f"Falling back to single-file inference for {len(remaining)} PDF(s) missing from batch response")
+
+        for record, pdf_part, cache_key in remaining:
+            async with limiter:
+                ai_data = await ainfer_attributes(record["structData"]["filename"], pdf_part, client, model_id, prompt_text)
+            if ai_data:
+                await attach(record, cache_key, ai_data)
+
+def build_record(filename, doc_id, target_dir, gcs_base, category, upload_date, stat=None):
+    """Builds the NDJSON record (without AI attributes) for a single PDF."""
+    filepath = os.path.join(target_dir, filename)
+    
+    # 1. Basic Metadata
+    file_meta = get_file_metadata(filepath, stat)
+    
+    # 2. Derived Metadata
+    title = clean_filename_to_title(filename)
+    gcs_uri = f"{gcs_base}/{filename}"
+    
+    struct_data = {
+        "title": title,
+        "filename": filename,
+        "category": category,
+        "file_size": file_meta["size_bytes"],
+        "modified_timestamp": file_meta["modified_timestamp"],
+        "upload_date": upload_date,
+        "source_local_path": os.path.abspath(filepath),
+        "gcs_uri": gcs_uri
+    }
+
+    # 3. Construct Record
+    return {
+        "id": doc_id,
+        "structData": struct_data,
+        "content": {
+            "mimeType": "application/pdf",
+            "uri": gcs_uri
+        }
+    }
+
+async def run_ai_inference(records, target_dir, client, model_id, prompt_text, concurrency, rate, prefetch, pdf_source, cache_dir, batch_size=1, batch_max_bytes=50 * 1024 * 1024, http_client=None):
+    """Runs AI inference as a producer/consumer pipeline with `concurrency` workers."""
+    num_consumers = max(1, concurrency)
+    # Bounded queue caps memory at roughly `prefetch` batches held in flight
+    queue = asyncio.Queue(maxsize=max(1, prefetch))
+    limiter = RateLimiter(rate)
+    cache = MetadataCache(cache_dir, model_id, prompt_text) if cache_dir else None
+
+    try:
+        await asyncio.gather(
+            produce_pdf_parts(records, target_dir, queue, num_consumers, pdf_source, cache, max(1, batch_size), batch_max_bytes),
+            *[consume_pdf_parts(queue, client, model_id, prompt_text, limiter, cache) for _ in range(num_consumers)]
+        )
+    finally:
+        # Close pooled connections on the event loop they were opened on
+        if http_client is not None:
+            await http_client.aclose()
+
 def main():
     parser = argparse.ArgumentParser(description="Generate NDJSON metadata for PDF documents in a folder.")
     parser.add_argument("folder", help="Path to the folder containing PDF documents")
     parser.add_argument("--gcs-base-uri", required=True, help="Base GCS URI (e.g. gs://bucket/path/to/docs)")
     parser.add_argument("--category", default="Technical Report", help="Default category for these documents")
+    parser.add_argument("--full-rebuild", action="store_true", help="Ignore the existing metadata.jsonl and re-run AI inference for every PDF")
+    parser.add_argument("--workers", type=int, default=1, help="Processes used to build file records (0 uses all CPUs; helps on large corpora or network filesystems)")
+    parser.add_argument("--hash", dest="hash_algo", choices=["blake2b", "md5"], default="blake2b", help="Hash used for document IDs (md5 keeps IDs from older runs)")
     
     # AI Arguments
     parser.add_argument("--infer-ai-attributes", action="store_true", help="Enable AI-based attribute extraction")
@@ -88,6 +448,13 @@ def main():
     parser.add_argument("--location", default="us-central1", help="GCP Location")
     parser.add_argument("--model", default="gemini-2.5-flash", help="Model ID to use")
     parser.add_argument("--prompt-file", default="src/document_preprocessing/metadata_extraction_prompt.txt", help="Path to prompt file")
+    parser.add_argument("--concurrency", type=int, default=8, help="Max concurrent AI inference requests")
+    parser.add_argument("--requests-per-second", type=float, default=1.0, help="Max AI inference requests started per second (0 disables)")
+    parser.add_argument("--prefetch", type=int, default=4, help="Max PDFs (or batches) read ahead of in-flight AI requests")
+    parser.add_argument("--pdf-source", choices=["local", "gcs"], default="local", help="Send PDFs inline from the local folder, or reference them by GCS URI (PDFs must already be uploaded)")
+    parser.add_argument("--cache-dir", default=".cache/metadata_ai", help="Directory caching AI results by PDF content, model and prompt (empty string disables)")
+    parser.add_argument("--batch-size", type=int, default=1, help="Max PDFs sent to Gemini in a single request")
+    parser.add_argument("--batch-max-mb", type=float, default=50, help="Max total PDF size (MB) per batched request")
 
     args = parser.parse_args()
     
@@ -95,6 +462,9 @@ def main():
     if not os.path.exists(target_dir):
         logger.error(f"Error: Directory '{target_dir}' does not exist.")
         return
+    if args.workers < 0:
+        logger.error("Error: --workers must be 0 (all CPUs) or a positive number of processes.")
+        return
         
     # Normalize GCS base URI
     gcs_base = args.gcs_base_uri.rstrip('/')
@@ -103,6 +473,7 @@ def main():
     
     # Initialize GenAI Client if needed
     client = None
+    http_client = None
     prompt_text = ""
     
     if args.infer_ai_attributes:
@@ -114,7 +485,14 @@ def main():
             return
             
         logger.info(f"Initializing GenAI Client for project {args.project}...")
-        client = genai.Client(vertexai=True, project=args.project, location=args.location)
+        # One client (and connection pool) is shared by all concurrent workers
+        http_client = build_async_http_client(args.concurrency)
+        client = genai.Client(
+            vertexai=True,
+            project=args.project,
+            location=args.location,
+            http_options=types.HttpOptions(httpx_async_client=http_client)
+        )
         
         if os.path.exists(args.prompt_file):
             with open(args.prompt_file, 'r') as f:
@@ -123,61 +501,71 @@ def main():
             logger.warning(f"Prompt file {args.prompt_file} not found. Using default.")
             prompt_text = "Extract metadata from this document as JSON."
 
-    files = [f for f in os.listdir(target_dir) if f.lower().endswith('.pdf')]
-    files.sort()
+    # A single scandir pass; its d_type lets is_file() skip a stat call on most filesystems
+    with os.scandir(target_dir) as it:
+        entries = sorted(
+            (e for e in it if is_pdf_filename(e.name) and e.is_file()),
+            key=lambda e: e.name
+        )
+    files = [e.name for e in entries]
     
     logger.info(f"Found {len(files)} PDF files in {target_dir}")
     logger.info(f"Generating metadata to {output_file}...")
     
-    # Track results
-    records = []
+    doc_ids = generate_doc_ids(files, args.hash_algo)
+    # All records in a batch share one upload timestamp
+    upload_date = datetime.now().isoformat()
     
-    for filename in files:
-        filepath = os.path.join(target_dir, filename)
-        
-        # 1. Basic Metadata
-        file_meta = get_file_metadata(filepath)
-        
-        # 2. Derived Metadata
-        doc_id = generate_doc_id(filename)
-        title = clean_filename_to_title(filename)
-        gcs_uri = f"{gcs_base}/{filename}"
-        
-        struct_data = {
-            "title": title,
-            "filename": filename,
-            "category": args.category,
-            "file_size": file_meta["size_bytes"],
-            "upload_date": datetime.now().isoformat(),
-            "source_local_path": os.path.abspath(filepath),
-            "gcs_uri": gcs_uri
-        }
+    if args.workers == 1:
+        # Reuses the DirEntry stat result (on POSIX this is still one stat call per file)
+        records = [
+            build_record(entry.name, doc_id, target_dir, gcs_base, args.category, upload_date, entry.stat())
+            for entry, doc_id in zip(entries, doc_ids)
+        ]
+    else:
+        # DirEntry objects cannot be pickled, so workers stat each file themselves
+        build = functools.partial(
+            build_record,
+            target_dir=target_dir, gcs_base=gcs_base, category=args.category, upload_date=upload_date
+        )
+        with ProcessPoolExecutor(max_workers=args.workers or os.cpu_count()) as executor:
+            records = list(executor.map(build, files, doc_ids, chunksize=16))
 
-        # 3. AI Inference
-        if args.infer_ai_attributes and client:
-            ai_data = infer_attributes(filepath, client, args.model, prompt_text)
-            if ai_data:
-                struct_data["ai_inferred_attributes"] = ai_data
-            time.sleep(1) # Rate limit protection
-
-        # 4. Construct Record
-        record = {
-            "id": doc_id,
-            "structData": struct_data,
-            "content": {
-                "mimeType": "application/pdf",
-                "uri": gcs_uri
-            }
-        }
-        records.append(record)
-        
-        # Write incrementally (optional, but good for progress)
-        # We write all at once at end to keep file clean or append? 
-        # Let's write incrementally to a temp list and then dump
+    # 4. AI Inference (concurrent, rate limited), skipping files unchanged since the last run
+    if args.infer_ai_attributes and client:
+        previous = {} if args.full_rebuild else load_previous_records(output_file)
+        prompt_digest = digest_prompt(prompt_text)
+        pending = [
+            r for r in records
+            if not (r["structData"]["filename"] in previous
+                    and reuse_unchanged_record(r, previous[r["structData"]["filename"]], args.model, prompt_digest))
+        ]
+        if len(pending) < len(records):
+            logger.info(f"Reusing AI attributes for {len(records) - len(pending)} unchanged PDF files")
+        asyncio.run(run_ai_inference(
+            pending, target_dir, client, args.model, prompt_text,
+            args.concurrency, args.requests_per_second, args.prefetch, args.pdf_source, args.cache_dir,
+            args.batch_size, int(args.batch_max_mb * 1024 * 1024), http_client
+        ))
+        # Record what produced the attributes so later runs only reuse them for the same model and prompt
+        for r in pending:
+            if "ai_inferred_attributes" in r["structData"]:
+                r["structData"]["ai_model_id"] = args.model
+                r["structData"]["ai_prompt_digest"] = prompt_digest
         
-    with open(output_file, 'w') as f:
-        for r in records:
-            f.write(json.dumps(r) + '\n')
+    # Write all records with a single write call, then atomically replace the output
+    fd, tmp_path = tempfile.mkstemp(dir=target_dir, prefix=".metadata.", suffix=".jsonl.tmp")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(serialize_records(records))
+    # mkstemp creates the file owner-only; keep the existing file's mode, else follow the umask
+    if os.path.exists(output_file):
+        mode = os.stat(output_file).st_mode & 0o7777
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    os.chmod(tmp_path, mode)
+    os.replace(tmp_path, output_file)
             
     logger.info(f"Done. Metadata saved to {output_file}")
 